@@ -1,13 +1,44 @@
+import hashlib
+import json
+import logging
 import os.path
 import shutil
+import signal
 import subprocess
+import threading
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
 
 from app.build import Builder
-from app.cmd import create_dir_if_not_exists, delete_dir_if_exists
+from app.cmd import create_dir_if_not_exists, link_or_copy
 
+logger = logging.getLogger(__name__)
 
 # https://github.com/golang/mobile/blob/master/cmd/gomobile/build_darwin_test.go
 
+# only these are inherited from the caller, everything else is set explicitly,
+# so go build cache keys do not depend on shell or terminal state
+INHERITED_ENV = [
+    "PATH",
+    "HOME",
+    "TMPDIR",
+    "DEVELOPER_DIR",
+    # network access for module downloads
+    "HTTP_PROXY",
+    "HTTPS_PROXY",
+    "NO_PROXY",
+    "http_proxy",
+    "https_proxy",
+    "no_proxy",
+    "SSL_CERT_FILE",
+    "SSL_CERT_DIR",
+]
+# go toolchain, cache, module and codegen settings (GOCACHE, GOMODCACHE,
+# GOEXPERIMENT, GOARM64, ...) are all inherited, so go build matches the
+# go mod tidy/go run in prepare_go and download_geo, which get the full env
+INHERITED_ENV_PREFIXES = ("GO", "CGO_")
+# set per target by the builder and kept out of the fingerprint
+HOST_ENV = ["GOMAXPROCS"]
+
 
 class AppleTarget(object):
     def __init__(
@@ -32,11 +63,24 @@ class AppleStaticLib(object):
 class AppleGoBuilder(Builder):
     def __init__(self, build_dir: str):
         super().__init__(build_dir)
+        # kept between builds, targets whose inputs did not change are reused
         self.framework_dir = os.path.join(self.lib_dir, "apple_xcframework")
-        delete_dir_if_exists(self.framework_dir)
         create_dir_if_not_exists(self.framework_dir)
+        self.build_state_file = os.path.join(self.framework_dir, ".build_state.json")
+        self.build_state: dict[str, str] = {}
+        self.source_digest = ""
+        self.go_version = ""
+        self._build_state_lock = threading.Lock()
         self.lib_file = "libXray.a"
         self.lib_header_file = "libXray.h"
+        self._sdk_path_cache: dict[str, str] = {}
+        self._sdk_version_cache: dict[str, str] = {}
+        self._tool_path_cache: dict[tuple[str, str], str] = {}
+        self._xcrun_lock = threading.Lock()
+        # running go build/lipo processes, killed as soon as any of them fails
+        self._processes: set[subprocess.Popen] = set()
+        self._processes_lock = threading.Lock()
+        self._aborted = threading.Event()
 
         self.ios_targets = [
             AppleTarget(
@@ -110,100 +154,358 @@ class AppleGoBuilder(Builder):
             ),
         ]
 
+        self.target_groups = [
+            self.ios_targets,
+            self.ios_simulator_targets,
+            self.macos_targets,
+            self.tvos_targets,
+            self.tv_simulator_targets,
+        ]
+        self.go_build_procs = 1
+
     def before_build(self):
+        self.check_toolchain()
         self.reset_files()
         super().before_build()
         self.clean_lib_dirs(["LibXray.xcframework"])
         self.prepare_static_lib()
 
+    def check_toolchain(self):
+        # fail before any go build is spawned, resolving sdks here also fills the caches
+        for tool in ["go", "xcrun", "lipo", "xcodebuild"]:
+            if shutil.which(tool) is None:
+                raise Exception(f"{tool} not found")
+        sdks = sorted(set(target.sdk for targets in self.target_groups for target in targets))
+        for sdk in sdks:
+            self.get_sdk_dir_path(sdk)
+            self.get_sdk_version(sdk)
+            self.get_tool_path(sdk, "clang")
+            self.get_tool_path(sdk, "clang++")
+
     def build(self):
         self.before_build()
-        # build ios
-        ios_lib = self.build_targets(self.ios_targets)[0]
-        self.create_framework(ios_lib)
-
-        ios_simulator_libs = self.build_targets(self.ios_simulator_targets)
-        ios_simulator_lib = self.merge_static_lib(ios_simulator_libs)
-        self.create_framework(ios_simulator_lib)
-
-        # build macos
-        macos_libs = self.build_targets(self.macos_targets)
-        macos_lib = self.merge_static_lib(macos_libs)
-        self.create_framework(macos_lib)
-        # build tvos
-        tvos_lib = self.build_targets(self.tvos_targets)[0]
-        self.create_framework(tvos_lib)
-
-        tv_simulator_libs = self.build_targets(self.tv_simulator_targets)
-        tv_simulator_lib = self.merge_static_lib(tv_simulator_libs)
-        self.create_framework(tv_simulator_lib)
+        self.build_state = self.load_build_state()
+        self.source_digest = self.hash_sources()
+        self.go_version = self.get_go_version()
+
+        # stale targets build at once, split the cores between them instead of oversubscribing
+        stale_targets = [
+            target
+            for targets in self.target_groups
+            for target in targets
+            if not self.is_target_up_to_date(
+                target.platform, target.go_arch, target.apple_arch, target.sdk, target.min_version
+            )
+        ]
+        self.go_build_procs = max(1, (os.cpu_count() or 1) // max(1, len(stale_targets)))
+
+        self.prepare_output_dirs()
+
+        # groups write to disjoint {sdk}-{arch} dirs, only the xcframework needs all of them
+        with ThreadPoolExecutor(max_workers=len(self.target_groups)) as executor:
+            futures = [
+                executor.submit(self.build_group, targets) for targets in self.target_groups
+            ]
+            libs = self.wait_futures(futures)
 
         self.after_build()
 
-        self.create_xcframework([ios_lib, ios_simulator_lib, macos_lib, tvos_lib, tv_simulator_lib])
+        self.create_xcframework(libs)
+
+    def wait_futures(self, futures: list[Future]) -> list:
+        try:
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        except KeyboardInterrupt:
+            # builds run in their own process groups, so Ctrl-C has to be forwarded
+            self.abort()
+            raise
+        errors = [future.exception() for future in done if future.exception() is not None]
+        if len(errors) > 0:
+            # stop the other builds instead of waiting minutes for a known failure
+            self.abort()
+            for future in not_done:
+                future.cancel()
+            for error in errors[1:]:
+                logger.error("build failed", exc_info=error)
+            # re-raise as is, so its type and traceback reach the user
+            raise errors[0]
+        return [future.result() for future in futures]
+
+    def abort(self):
+        self._aborted.set()
+        with self._processes_lock:
+            for process in self._processes:
+                # SIGINT to the whole group: go removes its $WORK dir, and the
+                # compile/cgo children holding the stderr pipe exit as well
+                try:
+                    os.killpg(process.pid, signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+
+    def run_cmd(self, cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
+        with self._processes_lock:
+            if self._aborted.is_set():
+                raise Exception(f"{cmd[0]} aborted, another build failed")
+            process = subprocess.Popen(cmd, stderr=subprocess.PIPE, process_group=0, **kwargs)
+            self._processes.add(process)
+        try:
+            _, stderr = process.communicate()
+        finally:
+            with self._processes_lock:
+                self._processes.discard(process)
+        return subprocess.CompletedProcess(cmd, process.returncode, stderr=stderr)
+
+    def prepare_output_dirs(self):
+        # create every output dir up front, the build steps expect them to exist
+        for targets in self.target_groups:
+            arches = sorted(set(target.apple_arch for target in targets))
+            lib_names = [f"{target.sdk}-{target.apple_arch}" for target in targets]
+            lib_names.append(AppleStaticLib(targets[0].sdk, arches).lib_name())
+            for lib_name in lib_names:
+                os.makedirs(os.path.join(self.framework_dir, lib_name), exist_ok=True)
+            framework_dir = os.path.join(self.framework_dir, lib_names[-1], "LibXray.framework")
+            os.makedirs(os.path.join(framework_dir, "Headers"), exist_ok=True)
+
+    def build_group(self, targets: list[AppleTarget]) -> AppleStaticLib:
+        libs = self.build_targets(targets)
+        lib = self.merge_static_lib(libs)
+        self.create_framework(lib)
+        return lib
 
     def build_targets(self, targets: list[AppleTarget]) -> list[AppleStaticLib]:
-        libs = []
-        for target in targets:
-            self.run_build_cmd(
-                target.platform,
-                target.go_arch,
-                target.apple_arch,
-                target.sdk,
-                target.min_version,
-            )
-            libs.append(AppleStaticLib(target.sdk, [target.apple_arch]))
-
-        return libs
+        # every target writes to its own {sdk}-{arch} dir, so they can build concurrently
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = [
+                executor.submit(
+                    self.run_build_cmd,
+                    target.platform,
+                    target.go_arch,
+                    target.apple_arch,
+                    target.sdk,
+                    target.min_version,
+                )
+                for target in targets
+            ]
+            self.wait_futures(futures)
+
+        return [AppleStaticLib(target.sdk, [target.apple_arch]) for target in targets]
 
     def run_build_cmd(
         self, platform: str, go_arch: str, apple_arch: str, sdk: str, min_version: str
     ):
+        if self.is_target_up_to_date(platform, go_arch, apple_arch, sdk, min_version):
+            logger.info("run_build_cmd for %s %s %s is up to date", platform, apple_arch, sdk)
+            return
+        cmd, run_env = self.target_build_cmd(platform, go_arch, apple_arch, sdk, min_version)
+        state_key = f"{sdk}-{apple_arch}"
+        fingerprint = self.target_fingerprint(sdk, cmd, run_env)
+        # parallelism depends on the host, so it is kept out of the fingerprint
+        cmd.insert(2, f"-p={self.go_build_procs}")
+        run_env["GOMAXPROCS"] = str(self.go_build_procs)
+        run_env = dict(sorted(run_env.items()))
+        logger.info("run_build_cmd for %s %s %s", platform, apple_arch, sdk)
+        logger.debug("env=%r cmd=%r", run_env, cmd)
+        # go overwrites the outputs in place, forget the old fingerprint first so a
+        # failed build can never leave a partial archive that looks up to date
+        self.save_build_state(state_key, None)
+        # targets build concurrently, keep their stderr apart and report it afterwards
+        ret = self.run_cmd(cmd, env=run_env, cwd=self.lib_dir)
+        stderr = ret.stderr.decode(errors="replace")
+        if ret.returncode != 0:
+            raise Exception(f"run_build_cmd for {platform} {apple_arch} {sdk} failed: {stderr}")
+        if stderr:
+            logger.warning("run_build_cmd for %s %s %s: %s", platform, apple_arch, sdk, stderr)
+        self.save_build_state(state_key, fingerprint)
+
+    def is_target_up_to_date(
+        self, platform: str, go_arch: str, apple_arch: str, sdk: str, min_version: str
+    ) -> bool:
+        output_dir = os.path.join(self.framework_dir, f"{sdk}-{apple_arch}")
+        output_file = os.path.join(output_dir, self.lib_file)
+        header_file = os.path.join(output_dir, self.lib_header_file)
+        cmd, run_env = self.target_build_cmd(platform, go_arch, apple_arch, sdk, min_version)
+        return (
+            self.build_state.get(f"{sdk}-{apple_arch}") == self.target_fingerprint(sdk, cmd, run_env)
+            and os.path.exists(output_file)
+            and os.path.exists(header_file)
+        )
+
+    def target_build_cmd(
+        self, platform: str, go_arch: str, apple_arch: str, sdk: str, min_version: str
+    ) -> tuple[list[str], dict[str, str]]:
         output_dir = os.path.join(self.framework_dir, f"{sdk}-{apple_arch}")
-        create_dir_if_not_exists(output_dir)
         output_file = os.path.join(output_dir, self.lib_file)
         sdk_path = self.get_sdk_dir_path(sdk)
         min_version_flag = f"-m{sdk}-version-min={min_version}"
         flags = f"-isysroot {sdk_path} {min_version_flag} -arch {apple_arch}"
-        run_env = os.environ.copy()
+        # GOCACHE/GOMODCACHE are never set here, go build uses the same caches
+        # as prepare_go and download_geo, whether they are default or configured
+        run_env = {
+            key: value
+            for key, value in os.environ.items()
+            if (key in INHERITED_ENV or key.startswith(INHERITED_ENV_PREFIXES))
+            and key not in HOST_ENV
+        }
         run_env["GOOS"] = platform
         run_env["GOARCH"] = go_arch
-        run_env["GOFLAGS"] = f"-tags={platform}"
-        run_env["CC"] = f"xcrun --sdk {sdk} --toolchain {sdk} clang"
-        run_env["CXX"] = f"xcrun --sdk {sdk} --toolchain {sdk} clang++"
+        run_env["GOFLAGS"] = f"{run_env.get('GOFLAGS', '')} -tags={platform}".strip()
+        # absolute paths, so cgo does not go through xcrun for every compile,
+        # clang picks the sdk up from SDKROOT instead
+        run_env["SDKROOT"] = sdk_path
+        run_env["CC"] = self.get_tool_path(sdk, "clang")
+        run_env["CXX"] = self.get_tool_path(sdk, "clang++")
         run_env["CGO_CFLAGS"] = flags
         run_env["CGO_CXXFLAGS"] = flags
         run_env["CGO_LDFLAGS"] = f"{flags} -Wl,-Bsymbolic-functions"
         run_env["CGO_ENABLED"] = "1"
         run_env["DARWIN_SDK"] = sdk
+        run_env = dict(sorted(run_env.items()))
 
         cmd = [
             "go",
             "build",
-            "-ldflags=-w",
+            "-trimpath",
+            "-ldflags=-s -w",
             f"-o={output_file}",
             "-buildmode=c-archive",
         ]
-        os.chdir(self.lib_dir)
-        print(run_env)
-        print(cmd)
-        ret = subprocess.run(cmd, env=run_env)
-        if ret.returncode != 0:
-            raise Exception(f"run_build_cmd for {platform} {apple_arch} {sdk} failed")
+        return cmd, run_env
+
+    def hash_sources(self) -> str:
+        # Xray-core is pulled in by a replace directive, so it is part of the inputs.
+        # every file is hashed, so cgo sources and embedded assets are covered too,
+        # only build tooling, downloaded geo data and build outputs are skipped
+        source_dirs = [self.lib_dir, os.path.join(self.lib_dir, "..", "Xray-core")]
+        skip_dirs = [
+            "build",
+            "dat",
+            "apple_xcframework",
+            "LibXray.xcframework",
+            "linux_so",
+            "windows_dll",
+        ]
+        skip_files = ["libXray.aar", "libXray-sources.jar"]
+        digest = hashlib.sha256()
+        for source_dir in source_dirs:
+            for root, dirs, files in os.walk(source_dir):
+                dirs[:] = sorted(
+                    d
+                    for d in dirs
+                    if not d.startswith(".")
+                    and not (root == self.lib_dir and d in skip_dirs)
+                )
+                for file in sorted(files):
+                    if file.startswith(".") or (root == self.lib_dir and file in skip_files):
+                        continue
+                    file_path = os.path.join(root, file)
+                    digest.update(os.path.relpath(file_path, source_dir).encode())
+                    # hashed in chunks, Xray-core is too big to read into memory file by file
+                    with open(file_path, "rb") as f:
+                        digest.update(hashlib.file_digest(f, "sha256").digest())
+        return digest.hexdigest()
+
+    def target_fingerprint(self, sdk: str, cmd: list[str], run_env: dict[str, str]) -> str:
+        # sdk path, min version and arch all end up in cmd or run_env, the sdk path
+        # is unversioned though, so an Xcode or Go upgrade needs the versions as well
+        data = json.dumps(
+            [self.source_digest, self.go_version, self.get_sdk_version(sdk), cmd, run_env],
+            sort_keys=True,
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def load_build_state(self) -> dict[str, str]:
+        if not os.path.exists(self.build_state_file):
+            return {}
+        # a broken state file only costs a full rebuild
+        try:
+            with open(self.build_state_file, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            logger.warning("ignoring unreadable %s", self.build_state_file)
+            return {}
+        if not isinstance(state, dict):
+            return {}
+        return state
+
+    def save_build_state(self, state_key: str, fingerprint: str | None):
+        with self._build_state_lock:
+            if fingerprint is None:
+                self.build_state.pop(state_key, None)
+            else:
+                self.build_state[state_key] = fingerprint
+            # write aside and rename, so an interrupted build never leaves truncated json
+            tmp_file = f"{self.build_state_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.build_state, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.build_state_file)
 
     def get_sdk_dir_path(self, sdk: str) -> str:
+        # targets of the same sdk build concurrently, resolve each sdk only once
+        with self._xcrun_lock:
+            if sdk not in self._sdk_path_cache:
+                self._sdk_path_cache[sdk] = self.run_sdk_dir_path_cmd(sdk)
+            return self._sdk_path_cache[sdk]
+
+    def run_sdk_dir_path_cmd(self, sdk: str) -> str:
         cmd = [
             "xcrun",
             "--sdk",
             sdk,
             "--show-sdk-path",
         ]
-        print(cmd)
+        logger.debug("cmd=%r", cmd)
         ret = subprocess.run(cmd, capture_output=True)
         if ret.returncode != 0:
             raise Exception(f"get_sdk_dir_path for {sdk} failed")
         return ret.stdout.decode().replace("\n", "")
 
+    def get_sdk_version(self, sdk: str) -> str:
+        with self._xcrun_lock:
+            if sdk not in self._sdk_version_cache:
+                self._sdk_version_cache[sdk] = self.run_sdk_version_cmd(sdk)
+            return self._sdk_version_cache[sdk]
+
+    def run_sdk_version_cmd(self, sdk: str) -> str:
+        cmd = [
+            "xcrun",
+            "--sdk",
+            sdk,
+            "--show-sdk-version",
+        ]
+        logger.debug("cmd=%r", cmd)
+        ret = subprocess.run(cmd, capture_output=True)
+        if ret.returncode != 0:
+            raise Exception(f"get_sdk_version for {sdk} failed")
+        return ret.stdout.decode().replace("\n", "")
+
+    def get_go_version(self) -> str:
+        cmd = ["go", "version"]
+        logger.debug("cmd=%r", cmd)
+        ret = subprocess.run(cmd, capture_output=True, cwd=self.lib_dir)
+        if ret.returncode != 0:
+            raise Exception("get_go_version failed")
+        return ret.stdout.decode().replace("\n", "")
+
+    def get_tool_path(self, sdk: str, tool: str) -> str:
+        with self._xcrun_lock:
+            if (sdk, tool) not in self._tool_path_cache:
+                self._tool_path_cache[(sdk, tool)] = self.run_tool_path_cmd(sdk, tool)
+            return self._tool_path_cache[(sdk, tool)]
+
+    def run_tool_path_cmd(self, sdk: str, tool: str) -> str:
+        cmd = [
+            "xcrun",
+            "--sdk",
+            sdk,
+            "-f",
+            tool,
+        ]
+        logger.debug("cmd=%r", cmd)
+        ret = subprocess.run(cmd, capture_output=True)
+        if ret.returncode != 0:
+            raise Exception(f"get_tool_path for {sdk} {tool} failed")
+        return ret.stdout.decode().replace("\n", "")
+
     def merge_static_lib(self, libs: list[AppleStaticLib]) -> AppleStaticLib:
         cmd = [
             "lipo",
@@ -212,32 +514,32 @@ class AppleGoBuilder(Builder):
         sdk = libs[0].sdk
         arches = list(set([item for row in map(lambda x: x.apple_archs, libs) for item in row]))
         arches.sort()
+        if len(arches) == 1:
+            # {sdk}-{arch} already holds the lib, nothing to merge
+            return AppleStaticLib(sdk, arches)
         for arch in arches:
             lib_dir = os.path.join(self.framework_dir, f"{sdk}-{arch}")
             lib_file = os.path.join(lib_dir, self.lib_file)
             cmd.extend(["-arch", arch, lib_file])
         arch = "-".join(arches)
         output_dir = os.path.join(self.framework_dir, f"{sdk}-{arch}")
-        create_dir_if_not_exists(output_dir)
         output_file = os.path.join(output_dir, self.lib_file)
         cmd.extend(["-output", output_file])
-        print(cmd)
-        ret = subprocess.run(cmd)
+        logger.debug("cmd=%r", cmd)
+        ret = self.run_cmd(cmd)
         if ret.returncode != 0:
-            raise Exception(f"merge_static_lib for {sdk} failed")
+            raise Exception(f"merge_static_lib for {sdk} failed: {ret.stderr.decode(errors='replace')}")
         return AppleStaticLib(sdk, arches)
 
     def create_framework(self, lib: AppleStaticLib):
         lib_name = lib.lib_name()
 
         framework_dir = os.path.join(self.framework_dir, lib_name, "LibXray.framework")
-        create_dir_if_not_exists(framework_dir)
 
         info_plist = os.path.join(self.build_dir, "template", "AppleGoInfo.plist")
         shutil.copy(info_plist, framework_dir)
 
         include_dir = os.path.join(framework_dir, "Headers")
-        create_dir_if_not_exists(include_dir)
 
         header_file = os.path.join(
             self.framework_dir,
@@ -255,7 +557,8 @@ class AppleGoBuilder(Builder):
             framework_dir,
             "LibXray"
         )
-        shutil.copy(lib_file, lib_dst)
+        # only the lib is big enough to be worth a hardlink
+        link_or_copy(lib_file, lib_dst)
 
 
     def create_xcframework(self, libs: list[AppleStaticLib]):
@@ -267,10 +570,11 @@ class AppleGoBuilder(Builder):
         output_file = os.path.join(self.lib_dir, "LibXray.xcframework")
         cmd.extend(["-output", output_file])
 
-        print(cmd)
-        ret = subprocess.run(cmd)
+        logger.debug("cmd=%r", cmd)
+        # xcodebuild only reports success on stdout, errors are kept from stderr
+        ret = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         if ret.returncode != 0:
-            raise Exception(f"create_framework failed")
+            raise Exception(f"create_xcframework failed: {ret.stderr.decode(errors='replace')}")
 
     def after_build(self):
         super().after_build()
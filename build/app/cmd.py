@@ -1,3 +1,4 @@
+import errno
 import os
 import shutil
 
@@ -15,3 +16,15 @@ def delete_dir_if_exists(work_dir: str):
 def delete_file_if_exists(file_path: str):
     if os.path.exists(file_path):
         os.remove(file_path)
+
+
+def link_or_copy(src: str, dst: str):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    delete_file_if_exists(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EMLINK):
+            raise
+        shutil.copy(src, dst)
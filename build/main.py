@@ -1,3 +1,4 @@
+import logging
 import os
 import sys
 
@@ -15,6 +16,7 @@ def build_dir_path():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     print(sys.argv)
     platform = sys.argv[1]
     if platform == "apple":